@@ -1,46 +1,80 @@
 
 # STDLIB
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import dataclasses
+import errno
 import filecmp
+import functools
+import json
 import multiprocessing
 import os
-import queue
+import resource
 import shutil
+import sqlite3
 import subprocess
 import sys
-import threading
+import tempfile
 import time
+import typing
 
-from astropy.io import fits
-
+# dataclass(slots=True) needs 3.10, os.waitstatus_to_exitcode() 3.9
+if sys.version_info < (3, 10):
+    sys.exit('Error: Python 3.10 or later is required')
 
-def cleanTree(src, ignore=None, function=os.remove):
-    # based on copy of shutil.copytree
-    names = os.listdir(src)
-    if ignore is not None:
-        ignored_names = ignore(src, names)
-    else:
-        ignored_names = set()
+from astropy.io import fits
 
-    errors = []
-    for name in names:
-        if name in ignored_names:
-            continue
-        srcname = os.path.join(src, name)
+# OPTIONAL
+try:
+    import fitsio  # CFITSIO's header parsing is considerably quicker than astropy's
+except ImportError:
+    fitsio = None
+
+
+def scanTree(src, ignore=None, onerror=None):
+    # Yields (dir relative to src, [os.DirEntry]) top down, where ignore is as for shutil.copytree(). Ignored and
+    # symlinked dirs aren't descended into. Uses os.scandir() so that each entry's type is had without a stat.
+    # If a dir can't be scanned onerror(relDir, err) is called and the rest of the tree still scanned, if no
+    # onerror is given the error is raised.
+    dirs = ['']
+    while dirs:
+        relDir = dirs.pop()
+        srcDir = os.path.join(src, relDir)
         try:
-            if os.path.isdir(srcname):
-                cleanTree(srcname, ignore, function)
-            else:
-                # Will raise a SpecialFileError for unsupported file types
-                function(srcname)
-        # catch the Error from the recursive copytree so that we can
-        # continue with other files
-        except Error as err:
-            errors.extend(err.args[0])
-        except EnvironmentError as why:
-            errors.append((srcname, str(why)))
+            with os.scandir(srcDir) as dirIter:
+                entries = list(dirIter)
+        except OSError as err:
+            if onerror is None:
+                raise
+            onerror(relDir, err)
+            continue
+        if ignore is not None:
+            ignored_names = ignore(srcDir, [entry.name for entry in entries])
+            entries = [entry for entry in entries if entry.name not in ignored_names]
+        yield relDir, entries
+        dirs.extend(os.path.join(relDir, entry.name) for entry in entries if entry.is_dir(follow_symlinks=False))
+
+def cleanTree(src, ignore=None, function=os.remove, maxThreads=None):
+    # Each remove is independent and I/O bound so run them concurrently. Only files are removed.
+    errors = []
+    removes = []
+    def onerror(relDir, why):
+        errors.append((os.path.join(src, relDir), str(why)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxThreads) as executor:
+        for relDir, entries in scanTree(src, ignore, onerror):
+            for entry in entries:
+                if not entry.is_dir():
+                    removes.append((entry.path, executor.submit(function, entry.path)))
+
+        for srcname, remove in removes:
+            try:
+                remove.result()
+            except EnvironmentError as why:
+                errors.append((srcname, str(why)))
     if errors:
-        raise Error(errors)
+        raise shutil.Error(errors)
 
 def makeOutputDir(outPath, ignoreError=False):
     # create output dir
@@ -58,201 +92,457 @@ def makeOutputDir(outPath, ignoreError=False):
     logPath = os.path.join(outPath, 'logs')
     os.mkdir(logPath)
 
-def moveTree(src, dst, ignore=None):
-    shutil.copytree(src, dst, ignore=ignore, copy_function=shutil.move)
+def ignoreSuffixes(*suffixes):
+    # As shutil.ignore_patterns('*<suffix>', ...) but using str.endswith() rather than fnmatch per name
+    def ignore(path, names):
+        return set(name for name in names if name.endswith(suffixes))
+    return ignore
 
-def walkAndFindFiles(path, suffix, keyword, value):
-
-    fileList = set()
-    value = str.lower(value)
-    if value == 't' or value == 'true':
-        value = True
-    elif value == 'f' or value == 'false':
-        value = False
-
-    for root, subDir, files in os.walk(path, topdown=True, followlinks=False):
-        for fname in files:
-            if suffix in fname:
-                fullFilePath = os.path.join(root, fname)
-                try:
-                    hdu = fits.open(fullFilePath, ignore_missing_end=True)
-                except OSError as err:
-                    pass  # do nothing
-                valueFound = hdu[0].header[keyword]
-
-                if valueFound == None:
-                    hdu.close()
-                    continue
-                hdu.close()
+def moveFile(src, dst):
+    # On the same filesystem a move is just a rename, only fall back to shutil.move's copy & delete across devices
+    try:
+        os.replace(src, dst)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
 
-                if type(valueFound) is bool:
-                    if valueFound == value:
-                        fileList.add(fullFilePath)
-                elif value == str.lower(valueFound):
-                    fileList.add(fullFilePath)
-    return fileList
+def moveTree(src, dst, ignore=None, maxThreads=None):
+    # Walk src creating the equivalent dirs under dst, as shutil.copytree(), and move the files
+    # concurrently as each is its own, I/O bound, rename. Symlinked dirs are moved as links, not descended.
+    # As shutil.copytree(), errors are collected, rather than aborting part way through, and raised at the end.
+    errors = []
+    moves = []
+    def onerror(relDir, why):
+        errors.append((os.path.join(src, relDir), os.path.join(dst, relDir), str(why)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxThreads) as executor:
+        for relDir, entries in scanTree(src, ignore, onerror):
+            try:
+                os.makedirs(os.path.join(dst, relDir), exist_ok=True)
+            except OSError as why:
+                onerror(relDir, why)
+                continue
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    relPath = os.path.join(relDir, entry.name)
+                    moves.append((relPath, executor.submit(moveFile, entry.path, os.path.join(dst, relPath))))
 
+        for relPath, move in moves:
+            try:
+                move.result()
+            except OSError as why:
+                errors.append((os.path.join(src, relPath), os.path.join(dst, relPath), str(why)))
+    if errors:
+        raise shutil.Error(errors)
+
+def moveTestOutputs(testFiles, srcRoot, dstRoot, suffix='raw.fits'):
+    # Move the output generated alongside testFiles, all from the same dir, i.e. the files sharing their
+    # rootnames, to the equivalent dir under dstRoot. The dir is scanned once, indexing its files by each
+    # possible rootname, i.e. each prefix followed by '_' or '.', rather than once per test.
+    srcDir = os.path.dirname(testFiles[0])
+    dstDir = os.path.join(dstRoot, os.path.relpath(srcDir, srcRoot))
+    index = collections.defaultdict(list)
+    with os.scandir(srcDir) as dirIter:
+        for entry in dirIter:
+            if entry.name.endswith(suffix) or not entry.is_file():
+                continue
+            for i, char in enumerate(entry.name):
+                if char == '_' or char == '.':
+                    index[entry.name[:i]].append(entry)
+
+    moved = set()  # as a file can be indexed under more than one rootname
+    for testFile in testFiles:
+        rootname = os.path.basename(testFile)[:-len(suffix)].rstrip('_')
+        for entry in index.get(rootname, ()):
+            if entry.name not in moved:
+                os.makedirs(dstDir, exist_ok=True)
+                moveFile(entry.path, os.path.join(dstDir, entry.name))
+                moved.add(entry.name)
+
+FITS_BLOCK_SIZE = 2880
+FITS_CARD_SIZE = 80
+FITS_HEADER_READ_BLOCKS = 8  # large enough for most primary headers while still a single small read
+
+def parseCardValue(valueStr):
+    valueStr = valueStr.strip()
+    if valueStr.startswith("'"):
+        # string values are quoted with any embedded quotes doubled, trailing spaces aren't significant
+        end = 1
+        while True:
+            end = valueStr.find("'", end)
+            if end == -1:
+                end = len(valueStr)
+                break
+            if valueStr[end + 1:end + 2] != "'":
+                break
+            end += 2
+        return valueStr[1:end].replace("''", "'").rstrip()
+
+    valueStr = valueStr.split('/', 1)[0].strip()
+    if valueStr == '':
+        return None
+    if valueStr == 'T':
+        return True
+    if valueStr == 'F':
+        return False
+    try:
+        if valueStr.startswith('(') and valueStr.endswith(')'):
+            # complex values are given as (real, imaginary)
+            real, imag = valueStr[1:-1].split(',')
+            return complex(parseNumber(real), parseNumber(imag))
+        return parseNumber(valueStr)
+    except ValueError:
+        return valueStr
+
+def parseNumber(valueStr):
+    # As astropy, integers are returned as int and reals, which may have a 'D' exponent, as float
+    valueStr = valueStr.strip()
+    # Python also accepts e.g. 'nan', 'inf' & '1_000', none of which are FITS numbers
+    if '_' in valueStr or not (valueStr.lstrip('+-')[:1].isdigit() or valueStr.lstrip('+-')[:1] == '.'):
+        raise ValueError(valueStr)
+    try:
+        return int(valueStr)
+    except ValueError:
+        return float(valueStr.replace('D', 'E'))
+
+def readPrimaryHeaderCards(path, cardNames, nBlocks=FITS_HEADER_READ_BLOCKS):
+    # Returns a dict of the requested keywords to their (unparsed) values, from the cards within the first
+    # nBlocks of the primary header, read with a single os.read(), and whether this is complete, i.e.
+    # whether all were found or END was reached, if not those missing may be further into the header.
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        header = os.read(fd, nBlocks * FITS_BLOCK_SIZE)
+    finally:
+        os.close(fd)
+
+    wanted = {str.encode(cardName.ljust(8), 'ascii'): cardName for cardName in cardNames}
+    cards = {}
+    for i in range(0, len(header) - FITS_CARD_SIZE + 1, FITS_CARD_SIZE):
+        name = header[i:i + 8]
+        if name == b'END     ':
+            return cards, True
+        cardName = wanted.get(name)
+        if cardName is not None and header[i + 8:i + 10] == b'= ' and cardName not in cards:
+            cards[cardName] = header[i + 10:i + FITS_CARD_SIZE].decode('ascii', errors='replace')
+            if len(cards) == len(wanted):
+                return cards, True
+    return cards, False
+
+def readPrimaryKeywords(path, keywords):
+    # Returns a dict of (upper case) keyword to value, None if absent, from a single read of the primary header.
+    # Only the primary header is needed so just read the start of the file directly rather than have
+    # astropy build an HDUList. Fall back to a full header parse if the header is longer than was read.
+    cardNames = [str.upper(keyword) for keyword in keywords]
+    cards, isComplete = readPrimaryHeaderCards(path, cardNames)
+    if isComplete:
+        return {cardName: parseCardValue(cards[cardName]) if cardName in cards else None for cardName in cardNames}
+
+    if fitsio is not None:
+        header = fitsio.read_header(path, ext=0)
+    else:
+        # Lazily load HDUs so only the primary is parsed, and don't memmap as only its header is read
+        with fits.open(path, mode='readonly', ignore_missing_end=True, lazy_load_hdus=True, memmap=False) as hdu:
+            header = hdu[0].header
+    return {cardName: header.get(cardName) for cardName in cardNames}
 
-def findFilesInList(list, keyword, value):
-    newList = set()
-    value = str.lower(value)
-    if value == 't' or value == 'true':
-        value = True
-    elif value == 'f' or value == 'false':
-        value = False
+def tryReadPrimaryKeywords(path, keywords):
+    try:
+        return readPrimaryKeywords(path, keywords)
+    except OSError:
+        return None
+
+def readHeadersConcurrently(paths, keywords, maxThreads=None):
+    # Yields (path, tryReadPrimaryKeywords(path, keywords)) pairs, reading the headers concurrently as this is I/O bound.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxThreads) as executor:
+        yield from executor.map(lambda path: (path, tryReadPrimaryKeywords(path, keywords)), paths)
+
+class HeaderCache:
+    # On disk cache of primary header values keyed by (path, mtime_ns, size) so that reruns over an
+    # unchanged tree needn't read the files again. Rows for files since changed are simply never matched.
+    # Use as a context manager such that the connection is committed and closed when done with.
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS headers '
+                                '(path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, header TEXT)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excInfo):
+        self.close()
+
+    def get(self, path, stat):
+        row = self.connection.execute('SELECT header FROM headers WHERE path = ? AND mtime_ns = ? AND size = ?',
+                                      (path, stat.st_mtime_ns, stat.st_size)).fetchone()
+        if row is None:
+            return {}
+        return json.loads(row[0])
+
+    def put(self, path, stat, header):
+        self.connection.execute('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)',
+                                (path, stat.st_mtime_ns, stat.st_size, json.dumps(header, default=str)))
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+def openHeaderCache(path):
+    # A HeaderCache for path, or, if no path, a context manager giving None, i.e. no caching
+    if not path:
+        return contextlib.nullcontext()
+    try:
+        return HeaderCache(path)
+    except sqlite3.Error as err:
+        sys.exit('Error: cannot open header cache "{0}" due to: {1}'.format(path, err))
+
+def mapPrimaryKeywords(paths, keywords, maxThreads=None, cache=None):
+    # As readHeadersConcurrently(paths, keywords, maxThreads) but, if given a HeaderCache,
+    # only reading those files not already cached, the cached headers are yielded first.
+    if cache is None:
+        yield from readHeadersConcurrently(paths, keywords, maxThreads)
+        return
 
-    for entry in list:
-        hdu = fits.open(entry)
-        found = hdu[0].header[keyword]
-        if found == None:
-            hdu.close()
+    cardNames = [str.upper(keyword) for keyword in keywords]
+    misses = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            yield path, None
+            continue
+        # Absolute as the cache is shared between runs which may be from different dirs
+        cached = cache.get(os.path.abspath(path), stat)
+        if all(cardName in cached for cardName in cardNames):
+            yield path, {cardName: cached[cardName] for cardName in cardNames}
+        else:
+            misses.append((path, stat, cached))
+
+    readHeaders = readHeadersConcurrently([path for path, stat, cached in misses], keywords, maxThreads)
+    for (path, stat, cached), (readPath, header) in zip(misses, readHeaders):
+        if header is not None:
+            # Merge with those already cached, as got above, such that keywords read by previous runs aren't lost
+            cached.update(header)
+            cache.put(os.path.abspath(path), stat, cached)
+        yield path, header
+    cache.commit()
+
+def findCandidateFiles(path, suffix):
+    # Use os.scandir() rather than os.walk() as the entries' cached file types save a stat per entry
+    dirs = [path]
+    while dirs:
+        try:
+            dirIter = os.scandir(dirs.pop())
+        except OSError:
+            continue  # as os.walk(), ignore unreadable dirs
+        with dirIter:
+            for entry in dirIter:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.name.endswith(suffix) and entry.is_file():  # N.B. opening e.g. a FIFO would block
+                    yield entry.path
+
+def walkAndBucketByKeyword(path, suffix, keyword, values, maxThreads=None, keepKeywords=(), cache=None):
+    # Walks path for files ending in suffix, bucketing them by their value of keyword, e.g. 'instrume',
+    # such that the tree is only walked, and each header read, once rather than once per value.
+    # Each bucket is a dict of path to the header values read for it, i.e. those for keyword and keepKeywords,
+    # so that these can be filtered on later by findFilesInList() without reading the files again.
+    buckets = {value: {} for value in values}
+    bucketNames = {str.lower(value): value for value in values}
+    keywords = [keyword] + list(keepKeywords)
+    cardName = str.upper(keyword)
+
+    for fullFilePath, header in mapPrimaryKeywords(findCandidateFiles(path, suffix), keywords, maxThreads, cache):
+        if header is None:
+            continue
+        valueFound = header[cardName]
+        if not isinstance(valueFound, str):
             continue
-        hdu.close()
 
-        if type(found) is bool:
-            if found == value:
-                newList.add(entry)
-        elif value == str.lower(found):
-            newList.add(entry)
-    return newList
+        bucket = bucketNames.get(str.lower(valueFound))
+        if bucket is not None:
+            buckets[bucket][fullFilePath] = header
+    return buckets
+
+def makeValueMatcher(value):
+    # Returns a predicate for whether a header value matches value, as given on the command line,
+    # i.e. case insensitively and with t/true & f/false matching booleans. The value is normalized,
+    # and the type of match chosen, once here rather than for every header tested.
+    # N.B. bools are matched by identity, and never against other values, as True == 1 and False == 0.
+    value = str.lower(value)
+    if value == 't' or value == 'true':
+        return lambda found: found is True
+    if value == 'f' or value == 'false':
+        return lambda found: found is False
+    # Compare others as strings such that numeric keywords, e.g. NAXIS, can also be matched
+    return lambda found: not isinstance(found, bool) and str.lower(str(found)) == value
+
+def findFilesInList(headers, keyword, value):
+    # Generator, so wrap in set() if the results need counting or more than one pass.
+    # headers is a dict of path to header values, as from walkAndBucketByKeyword(), these are
+    # filtered on directly rather than reading the files again.
+    matches = makeValueMatcher(value)
+    cardName = str.upper(keyword)
+    for entry, header in headers.items():
+        found = header.get(cardName)
+        if found is not None and matches(found):
+            yield entry
 
 def formatSeconds(seconds):
     m, s = divmod(seconds, 60)
     h, m = divmod(m, 60)
     return '{0}hrs:{1}mins:{2}secs'.format(h, m, s)
 
-class AtomicCounter():
-    def __init__(self, value=0):
-        self.count = value
-        self.lock = threading.Lock()
-
-    def inc(self, value=1):
-        with self.lock:
-            self.count += value
-
-    def dec(self, value=1):
-        with self.lock:
-            self.count -= value
-
-    def get(self):
-        with self.lock:
-            return self.count
-
-    def set(self, value=0):
-        with self.lock:
-            self.count = value
-
-nPassed = AtomicCounter()
-nFailed = AtomicCounter()
-
-class TestQueueItem:
-    def __init__(self, _testFile, _cmd, _outPath):
-        self.testFile = _testFile
-        self.cmd = _cmd
-        self.outPath = _outPath
-        self.version = self.getVersion()
-        self.results = None
-
-        logPath = os.path.join(self.outPath, 'logs')
-        logFile = os.path.basename(self.testFile) + '.log'
-        self.logFile = os.path.join(logPath, logFile)
-
-    def run(self):
-        os.chdir(self.outPath)
-
-        print('Processing "{0}"...'.format(self.testFile))
-
-        cmd = self.cmd + ' -v ' + ' -1 ' + self.testFile  # args needs to be single string if shell=True
-        self.results = subprocess.run(cmd, shell=True, check=False, universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        # self.results = subprocess.run(args=[self.cmd, "-v", "-1", self.testFile], shell=False, check=False, universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if self.results.returncode:
-            print('"{0}" failed'.format(self.testFile))
-            nFailed.inc()
-        else:
-            print('"{0}" succeeded'.format(self.testFile))
-            nPassed.inc()
-
-    def log(self):
+@dataclasses.dataclass(slots=True)
+class TestItem:
+    testFile: str
+    cmd: str
+    outPath: str
+    results: typing.Optional[subprocess.CompletedProcess] = None
+    wallTime: typing.Optional[float] = None
+    rusage: typing.Optional[resource.struct_rusage] = None
+
+def runTestItem(test):
+    print('Processing "{0}"...'.format(test.testFile))
+
+    # Pass cwd rather than os.chdir() as the latter is process wide and so races between worker threads.
+    # Capture the output in temporary files, rather than pipes, so that the child can be reaped directly
+    # with os.wait4(), giving its resource usage, without having to concurrently drain pipes.
+    cmd = [test.cmd, "-v", "-1", test.testFile]
+    with tempfile.TemporaryFile(mode='w+') as stdout, tempfile.TemporaryFile(mode='w+') as stderr:
+        startTime = time.monotonic()
         try:
-            fid = open(self.logFile, mode='w')
+            with subprocess.Popen(cmd, shell=False, stdout=stdout, stderr=stderr, cwd=test.outPath) as process:
+                pid, status, test.rusage = os.wait4(process.pid, 0)
+                test.wallTime = time.monotonic() - startTime
+                process.returncode = os.waitstatus_to_exitcode(status)
         except OSError as err:
-            print('ERROR: Cannot write log file "{0}" due to:'.format(self.logFile))
-            print('"{0}"'.format(err))
+            # e.g. a missing or non executable program, record this as a failed test, as a shell would with 127,
+            # rather than letting it abort the whole run
+            test.wallTime = 0.0
+            test.rusage = resource.struct_rusage((0,) * resource.struct_rusage.n_fields)
+            test.results = subprocess.CompletedProcess(cmd, 127, '', str(err))
         else:
-            fid.write('Input file: "{0}"\n'.format(self.testFile))
-            fid.write('Program: "{0}"\n'.format(self.cmd))
-            fid.write('Version: {0}\n'.format(str(self.version)))
-            fid.write('return code:{0}\n\n'.format(str(self.results.returncode)))
-            fid.write('stdout results:\n {0}\n\n'.format(str(self.results.stdout)))
-            fid.write('stderr results:\n {0}\n\n'.format(str(self.results.stderr)))
-            fid.close()
-
-    def getVersion(self):
-        try:
-            return subprocess.run([self.cmd, "--version"], shell=False, check=False, stdout=subprocess.PIPE, universal_newlines=True).stdout
-        except:
-            return None
+            stdout.seek(0)
+            stderr.seek(0)
+            test.results = subprocess.CompletedProcess(cmd, process.returncode, stdout.read(), stderr.read())
 
+    if test.results.returncode:
+        print('"{0}" failed'.format(test.testFile))
+    else:
+        print('"{0}" succeeded'.format(test.testFile))
+
+def formatTestLog(test):
+    return ''.join(['Input file: "{0}"\n'.format(test.testFile),
+                    'Program: "{0}"\n'.format(test.cmd),
+                    'Version: {0}\n'.format(str(getVersion(test.cmd))),
+                    'return code:{0}\n'.format(str(test.results.returncode)),
+                    'Wall time: {0:.3f} (seconds)\n'.format(test.wallTime),
+                    'User time: {0:.3f} (seconds)\n'.format(test.rusage.ru_utime),
+                    'System time: {0:.3f} (seconds)\n'.format(test.rusage.ru_stime),
+                    'Max resident set size: {0} (kbytes)\n\n'.format(test.rusage.ru_maxrss),
+                    'stdout results:\n {0}\n\n'.format(str(test.results.stdout)),
+                    'stderr results:\n {0}\n\n'.format(str(test.results.stderr))])
+
+def logTestItem(test):
+    # Format the whole log first such that it's written with a single write()
+    logFile = os.path.join(test.outPath, 'logs', os.path.basename(test.testFile) + '.log')
+    text = formatTestLog(test)
+    try:
+        with open(logFile, mode='w') as fid:
+            fid.write(text)
+    except OSError as err:
+        print('ERROR: Cannot write log file "{0}" due to:'.format(logFile))
+        print('"{0}"'.format(err))
+
+def runTest(test):
+    runTestItem(test)
+    return test
+
+@functools.lru_cache(maxsize=None)
+def getVersion(cmd):
+    # All tests share the same few executables so only ask each for its version once
+    try:
+        return subprocess.run([cmd, "--version"], shell=False, check=False, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    except:
+        return None
 
-def compareResults(path1, path2, outPath):
 
-    def countSuffixOnly(dcmpList, suffix):
-        count = 0
-        if suffix:
-            for entry in dcmpList:
-                if entry.endswith(suffix):
-                    count = count + 1
-        else:
-            count = len(dcmpList)
-        return count
-
-    def countDiff(parentCmp, suffix=None):
-        count = countSuffixOnly(parentCmp.diff_files, suffix)
-        for subDir in parentCmp.subdirs.values():
-            count = count + countDiff(subDir, suffix)
-        return count
-
-    def countLeftOnly(parentCmp, suffix=None):
-        count = countSuffixOnly(parentCmp.left_only, suffix)
-        for subDir in parentCmp.subdirs.values():
-            count = count + countLeftOnly(subDir, suffix)
-        return count
-
-    def countRightOnly(parentCmp, suffix=None):
-        count = countSuffixOnly(parentCmp.right_only, suffix)
-        for subDir in parentCmp.subdirs.values():
-            count = count + countRightOnly(subDir, suffix)
-        return count
-
-    def recursiveFITSDiff(parentCmp, ignore):
-        # bottom up
-
-        comparison = []
-        for subDirCmp in parentCmp.subdirs.values():
-            comparison.extend(recursiveFITSDiff(subDirCmp, ignore))
-
-        for file in parentCmp.common_files:
-            if not file.endswith('.fits'):
-            #if '.fits' not in file:
-                continue
+def diffFITSPair(pair, ignore=None):
+    # Module level, and only returning what's needed as FITSDiff objects don't pickle, for multiprocessing.Pool
+    a, b = pair
+    # N.B. numdiffs=0 is already the cheapest setting, it only limits how many of the differing values are kept
+    diff = fits.FITSDiff(a, b, ignore_keywords=ignore, numdiffs=0, ignore_blank_cards=True)
+    return a, b, diff.identical
 
-            a = os.path.join(parentCmp.left, file)
-            b = os.path.join(parentCmp.right, file)
+def scanDir(path):
+    # Returns a dict of name to os.DirEntry, ignoring those filecmp.dircmp() does by default
+    with os.scandir(path) as dirIter:
+        return {entry.name: entry for entry in dirIter if entry.name not in filecmp.DEFAULT_IGNORES}
 
+COMPARE_BUFFER_SIZE = 1024 * 1024
+
+def sameContents(a, b, bufferSize=COMPARE_BUFFER_SIZE):
+    # As filecmp.cmp(a, b, shallow=False) for files already known to be the same size, but with large
+    # unbuffered reads rather than 8KiB buffered ones. Compares bytes, which is a memcmp(), and unlike
+    # hashing each file this still stops at the first chunk that differs.
+    with open(a, 'rb', buffering=0) as aFile, open(b, 'rb', buffering=0) as bFile:
+        while True:
+            aChunk = aFile.read(bufferSize)
+            if aChunk != bFile.read(bufferSize):
+                return False
+            if not aChunk:
+                return True
+
+def diffTree(left, right, maxThreads=None):
+    # os.scandir() based recursive filecmp.dircmp(), returning {'left', 'right', 'same', 'diff', 'funny': [relPath]}
+    results = {category: [] for category in ('left', 'right', 'same', 'diff', 'funny')}
+    toCompare = []
+    dirs = ['']
+    while dirs:
+        relDir = dirs.pop()
+        leftEntries = scanDir(os.path.join(left, relDir))
+        rightEntries = scanDir(os.path.join(right, relDir))
+        results['left'].extend(os.path.join(relDir, name) for name in leftEntries.keys() - rightEntries.keys())
+        results['right'].extend(os.path.join(relDir, name) for name in rightEntries.keys() - leftEntries.keys())
+
+        for name in leftEntries.keys() & rightEntries.keys():
+            relPath = os.path.join(relDir, name)
+            a = leftEntries[name]
+            b = rightEntries[name]
             try:
-                diff = fits.FITSDiff(a, b, ignore_keywords=ignore, numdiffs=0, ignore_blank_cards=True)
-            except OSError as err:
-                # print(err)
-                # continue
-                raise err
-            if  diff.identical:
-                print('"{0}" & "{1}" are identical'.format(a, b))
+                if a.is_dir() and b.is_dir():
+                    dirs.append(relPath)
+                    continue
+                if a.is_dir() or b.is_dir():
+                    continue
+                aStat = a.stat()
+                bStat = b.stat()
+            except OSError:
+                results['funny'].append(relPath)
+                continue
+
+            if aStat.st_size != bStat.st_size:
+                results['diff'].append(relPath)
+            elif aStat.st_mtime_ns == bStat.st_mtime_ns:
+                results['same'].append(relPath)  # as dircmp(), trust matching stat signatures
             else:
-                print('"{0}" & "{1}" differ'.format(a, b))
-            comparison.append(diff)
+                toCompare.append(relPath)
 
-        return comparison
+    def compare(relPath):
+        try:
+            return 'same' if sameContents(os.path.join(left, relPath), os.path.join(right, relPath)) else 'diff'
+        except OSError:
+            return 'funny'
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxThreads) as executor:
+        for relPath, category in zip(toCompare, executor.map(compare, toCompare)):
+            results[category].append(relPath)
+    return results
 
+def compareResults(path1, path2, outPath, maxThreads=None, maxIOThreads=None):
     if path1 == None or path2 == None or outPath == None:
         return
 
@@ -265,17 +555,23 @@ def compareResults(path1, path2, outPath):
         sys.exit('ERROR: the output path, "{0}", does not exist'.format(outPath))
 
     # Quick dir comparison for simple stats
-
-    # this wont foe
-    dirDiff = filecmp.dircmp(path1, path2)
-    nDiff = countDiff(dirDiff)
-    nLogsDiff = countDiff(dirDiff, '.log')
-    nTrailersDiff = countDiff(dirDiff, '.tra')
-    nFitsDiff = countDiff(dirDiff, '.fits')
+    treeDiff = diffTree(path1, path2, maxIOThreads)
+    # Count the diff, left only & right only entries, in total, i.e. suffix None, and per suffix
+    counts = collections.Counter()
+    for category in ('diff', 'left', 'right'):
+        counts[category, None] = len(treeDiff[category])
+        for entry in treeDiff[category]:
+            for suffix in ('.log', '.tra', '.fits'):
+                if entry.endswith(suffix):
+                    counts[category, suffix] += 1
+    nDiff = counts['diff', None]
+    nLogsDiff = counts['diff', '.log']
+    nTrailersDiff = counts['diff', '.tra']
+    nFitsDiff = counts['diff', '.fits']
 
     print('\n{0} file(s) differ between paths:\n\t{1} of them ".log" files\n\t{2} of them ".tra" files\n\t{3} of them ".fits" files'.format(nDiff, nLogsDiff, nTrailersDiff, nFitsDiff))
-    print('{0} orphaned file(s)/dir(s) found:\n\t{1} of them log files\n\t{2} of them ".tra" files\n\t{3} of them ".fits" files'.format(countLeftOnly(dirDiff), countLeftOnly(dirDiff, '.log'), countLeftOnly(dirDiff, '.tra'), countLeftOnly(dirDiff, '.fits')))
-    print('{0} newly generated file(s)/dir(s) found\n\t{1} of them log files\n\t{2} of them ".tra" files\n\t{3} of them ".fits" files\n'.format(countRightOnly(dirDiff), countRightOnly(dirDiff, '.log'), countLeftOnly(dirDiff, '.tra'), countLeftOnly(dirDiff, '.fits')))
+    print('{0} orphaned file(s)/dir(s) found:\n\t{1} of them log files\n\t{2} of them ".tra" files\n\t{3} of them ".fits" files'.format(counts['left', None], counts['left', '.log'], counts['left', '.tra'], counts['left', '.fits']))
+    print('{0} newly generated file(s)/dir(s) found\n\t{1} of them log files\n\t{2} of them ".tra" files\n\t{3} of them ".fits" files\n'.format(counts['right', None], counts['right', '.log'], counts['right', '.tra'], counts['right', '.fits']))
 
     if nDiff == 0:
         print('Regression PASSED! All files identical')
@@ -287,11 +583,21 @@ def compareResults(path1, path2, outPath):
     # return
     # FITSDiff common files
     ignore = ['DATE']
-    diffList = recursiveFITSDiff(dirDiff, ignore)
     failCount = 0
-    for item in diffList:
-        if not item.identical:
-            failCount += 1
+    # The common files have already been compared so only those that differ need FITS diffing
+    for entry in treeDiff['same']:
+        if entry.endswith('.fits'):
+            print('"{0}" & "{1}" are identical'.format(os.path.join(path1, entry), os.path.join(path2, entry)))
+    diffPairs = [(os.path.join(path1, entry), os.path.join(path2, entry)) for entry in treeDiff['diff'] + treeDiff['funny'] if entry.endswith('.fits')]
+
+    # FITSDiff is CPU bound so spread the pairs over processes
+    with multiprocessing.Pool(maxThreads) as pool:
+        for a, b, identical in pool.imap_unordered(functools.partial(diffFITSPair, ignore=ignore), diffPairs):
+            if identical:
+                print('"{0}" & "{1}" are identical'.format(a, b))
+            else:
+                print('"{0}" & "{1}" differ'.format(a, b))
+                failCount += 1
 
     print('{0} files differ (ignoring {1})'.format(failCount, ignore))
 
@@ -326,28 +632,50 @@ def main(argv):
                             help='Clean <root data path> leaving only *raw.fits files.')
     parser.add_argument('--move', metavar='<path>', dest='move', nargs=2, default=None,
                             help='Move all none *raw.fits files in <1st path> to <2nd path>/results')
-    parser.add_argument('-n', '--maxThreads', dest='maxThreads', nargs=1, default=multiprocessing.cpu_count(),
+    parser.add_argument('-n', '--maxThreads', dest='maxThreads', nargs=1, default=[multiprocessing.cpu_count()],
                             help='The maximum number of threads to use to spawn jobs', type=int)
     parser.add_argument('--find', dest='optFind', nargs='*', default=None,
                             help='Recurse through 1st arg <path> for files with 2nd arg <keyword> \
                             set to 3rd arg <value> and print all found')
+    parser.add_argument('--cache', metavar='<path>', dest='cachePath', nargs=1, default=None,
+                            help='Cache header values read in the sqlite database <path>, created if needed, \
+                            such that subsequent runs only read new or changed files')
     args = parser.parse_args(argv)
 
+    nCores = multiprocessing.cpu_count()
+    if args.maxThreads[0] <= 0 or args.maxThreads[0] > nCores:
+        nThreads = nCores
+    else:
+        nThreads = args.maxThreads[0]
+    # Header reads are I/O bound so use more threads for these such that more reads are in flight at once
+    nIOThreads = min(32, nThreads * 4)
+    cachePath = args.cachePath[0] if args.cachePath else None
+
     if args.optFind != None:
         if len(args.optFind) < 3:
             print('ERROR: incorrect number of arguments for --find')
             return
         length = len(args.optFind)
-        foundSet = walkAndFindFiles(args.optFind[0], 'raw.fits', args.optFind[1], args.optFind[2])
-        if length > 3:
-            for i in range(3, length, 3):
-                op = args.optFind[i]
-                keyword = args.optFind[i + 1]
-                value = args.optFind[i + 2]
-                if str.lower(op) == 'and':
-                    foundSet = findFilesInList(foundSet, keyword, value)
-                elif str.lower(op) == 'or':
-                    foundSet = foundSet | findFilesInList(foundSet, keyword, value)
+        terms = []
+        for i in range(3, length, 3):
+            terms.append((str.lower(args.optFind[i]), args.optFind[i + 1], args.optFind[i + 2]))
+
+        # Read every keyword needed by any of the terms from each file in a single pass, the terms
+        # are then all evaluated against these rather than reading the files again per term.
+        keywords = set([args.optFind[1]] + [keyword for op, keyword, value in terms])
+        candidates = findCandidateFiles(args.optFind[0], 'raw.fits')
+        headers = {}
+        with openHeaderCache(cachePath) as cache:
+            for fullFilePath, header in mapPrimaryKeywords(candidates, keywords, nIOThreads, cache):
+                if header is not None:
+                    headers[fullFilePath] = header
+
+        foundSet = set(findFilesInList(headers, args.optFind[1], args.optFind[2]))
+        for op, keyword, value in terms:
+            if op == 'and':
+                foundSet = set(findFilesInList({entry: headers[entry] for entry in foundSet}, keyword, value))
+            elif op == 'or':
+                foundSet = foundSet | set(findFilesInList(headers, keyword, value))
         printList(foundSet)  # use set to dedup
         print('{0} files found'.format(len(foundSet)))
         return
@@ -359,16 +687,16 @@ def main(argv):
         makeOutputDir(dst, ignoreError=True)
         dst = os.path.join(dst, 'results')
         print('Moving all none *raw.fits files in "{0}" to "{1}".'.format(src, dst))
-        moveTree(src, dst, ignore=shutil.ignore_patterns('*raw.fits'))
+        moveTree(src, dst, ignore=ignoreSuffixes('raw.fits'), maxThreads=nIOThreads)
         return
 
     if args.clean and len(args.clean) == 1:
         print('Cleaning: removing all none *raw.fits files from "{0}"'.format(args.clean[0]))
-        cleanTree(args.clean[0], ignore=shutil.ignore_patterns('*raw.fits'))
+        cleanTree(args.clean[0], ignore=ignoreSuffixes('raw.fits'), maxThreads=nIOThreads)
         return
 
     if args.diffOnly and len(args.diffOnly) == 2:
-        compareResults(args.diffOnly[0], args.diffOnly[1], args.outPath[0])
+        compareResults(args.diffOnly[0], args.diffOnly[1], args.outPath[0], nThreads, nIOThreads)
         print('\nTime taken to diff: {0} (seconds)'.format(str(time.time() - startTime)))
         return
 
@@ -380,9 +708,10 @@ def main(argv):
     else:
         diffOnTheFly = False
 
-    outPath = args.outPath[0]
-    regressionPath = args.regressionPath[0]
-    execPath = args.execPath[0]
+    # Absolute so that test files etc. resolve the same from the tests' cwd, i.e. outPath, as from ours
+    outPath = os.path.abspath(args.outPath[0])
+    regressionPath = os.path.abspath(args.regressionPath[0])
+    execPath = os.path.abspath(args.execPath[0])
 
     print('Path containing test data: "{0}"'.format(regressionPath))
     if os.path.exists(regressionPath) == False:
@@ -400,17 +729,19 @@ def main(argv):
 
     print('\n')
 
-    # Walking through each separately is slow, so thread (tried this, damn GIL! process spawning didn't make a diff either)
-    acsInput = []
-    stisInput = []
-    wf3Input = []
+    # Walking through each instrument separately is slow, so walk once and bucket files by instrument
+    # For CTE only also keep PCTECORR so that filtering on it later doesn't need the files reading again
     if args.cteOnly:
-        # acsInput = walkAndFindFiles(regressionPath, 'raw.fits', 'instrume', 'ACS')
-        wf3Input = walkAndFindFiles(regressionPath, 'raw.fits', 'instrume', 'WFC3')
+        instruments = ['WFC3']  # 'ACS'
+        keepKeywords = ['PCTECORR']
     else:
-        stisInput = walkAndFindFiles(regressionPath, 'raw.fits', 'instrume', 'STIS')
-        acsInput = walkAndFindFiles(regressionPath, 'raw.fits', 'instrume', 'ACS')
-        wf3Input = walkAndFindFiles(regressionPath, 'raw.fits', 'instrume', 'WFC3')
+        instruments = ['STIS', 'ACS', 'WFC3']
+        keepKeywords = []
+    with openHeaderCache(cachePath) as cache:
+        inputs = walkAndBucketByKeyword(regressionPath, 'raw.fits', 'instrume', instruments, nIOThreads, keepKeywords, cache)
+    acsInput = inputs.get('ACS', {})
+    stisInput = inputs.get('STIS', {})
+    wf3Input = inputs.get('WFC3', {})
 
     print('{0} acs input files found.'.format(str(len(acsInput))))
     print('{0} stis input files found.'.format(str(len(stisInput))))
@@ -421,13 +752,13 @@ def main(argv):
         print('No input data files found! Terminating...')
         return
 
-    testQueue = queue.Queue()
+    tests = []
 
     if args.cteOnly:
         print('Processing CTE corrections only.')
 
-        CTEInput = findFilesInList(wf3Input, 'PCTECORR', 'PERFORM')
-        CTEInput.extend(findFilesInList(acsInput, 'PCTECORR', 'PERFORM'))
+        CTEInput = set(findFilesInList(wf3Input, 'PCTECORR', 'PERFORM'))
+        CTEInput.update(findFilesInList(acsInput, 'PCTECORR', 'PERFORM'))
         print('{0} wf3cte input files found.'.format(str(len(CTEInput))))
         if len(CTEInput) == 0:
             print('Terminating...')
@@ -436,8 +767,7 @@ def main(argv):
         exe = os.path.join(execPath, 'wf3cte.e')
         checkExeExists(exe)
         for test in CTEInput:
-            testItem = TestQueueItem(test, exe, outPath)
-            testQueue.put(testItem)
+            tests.append(TestItem(test, exe, outPath))
     else:
         # queue rest of pipeline tests
         # This suite is data-file driven, i.e. the data-files are the tests.
@@ -447,74 +777,84 @@ def main(argv):
         exe = os.path.join(execPath, 'calacs.e')
         checkExeExists(exe)
         for test in acsInput:
-            testItem = TestQueueItem(test, exe, outPath)
-            testQueue.put(testItem)
+            tests.append(TestItem(test, exe, outPath))
 
         # Then STIS
         exe = os.path.join(execPath, 'calstis.e')
         checkExeExists(exe)
         for test in stisInput:
-            testItem = TestQueueItem(test, exe, outPath)
-            testQueue.put(testItem)
+            tests.append(TestItem(test, exe, outPath))
 
         # Then WFC3
         exe = os.path.join(execPath, 'calwf3.e')
         checkExeExists(exe)
         for test in wf3Input:
-            testItem = TestQueueItem(test, exe, outPath)
-            testQueue.put(testItem)
+            tests.append(TestItem(test, exe, outPath))
 
     # Delay doing this such that any failed runs of this code (in adequate paths or zero files found)
     # do not create this directory preventing subsequent attempts due output dir already existing error.
     makeOutputDir(outPath)
-    os.chdir(outPath)
 
 
-    def tester():
-        # spin
-        while True:
-            try:
-                test = testQueue.get(block=False, timeout=10)
-                test.run()
-                test.log()
-                testQueue.task_done()  # not sure if really needed or even wanted
-                print('~{0} tests remaining'.format(testQueue.qsize()))
-            except queue.Empty:  # only raised when either timeout expires (blocking) or queue empty (nonblocking)
-                return
-
-
-    # Create thread pool.
-    # Since only using these to run subprocesses.run we don't care about the GIL or
-    # that these are threaded rather than multiprocess.
-    threadPool = []
-    nCores = multiprocessing.cpu_count()
-    if args.maxThreads[0] <= 0 or args.maxThreads[0] > nCores:
-        nThreads = nCores
-    else:
-        nThreads = args.maxThreads[0]
-    queueLength = testQueue.qsize()
+    queueLength = len(tests)
     # Now limit this if greater than items in queue
     if nThreads > queueLength:
         print('Limiting the number of threads to size of queue, {0}, from {1}.'.format(queueLength, nThreads))
         nThreads = queueLength
     print('\nUsing {0} thread(s) to spawn jobs.'.format(nThreads))
 
-    for i in range(nThreads):
-        thread = threading.Thread(target=tester)
-        thread.start()
-        threadPool.append(thread)
-
-    # block until all tasks are done
-    testQueue.join()
+    # The workers only spawn and wait on subprocesses so threads, rather than processes, are fine and
+    # save forking a copy of this interpreter per worker.
+    # Tally results as they're completed rather than sharing counters between workers.
+    # Also move the tests' output to outPath/results in the background as soon as all those in a dir are done,
+    # rather than all at the end, so that this is hidden behind the tests still running. Waiting for the whole
+    # dir means it's only scanned once, rather than once per test, as new output is still appearing until then.
+    # Likewise write the logs from a single background thread rather than from every worker at once.
+    resultsPath = os.path.join(outPath, 'results')
+    nTestsPassed = 0
+    moves = []
+    logs = []
+    nTestsLeftPerDir = collections.Counter(os.path.dirname(test.testFile) for test in tests)
+    testsDonePerDir = collections.defaultdict(list)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nThreads) as executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as mover, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as logger:
+        futures = [executor.submit(runTest, test) for test in tests]
+        for nTestsDone, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            test = future.result()
+            if not test.results.returncode:
+                nTestsPassed += 1
+            print('~{0} tests remaining'.format(queueLength - nTestsDone))
+            logs.append((test.testFile, logger.submit(logTestItem, test)))
+            testDir = os.path.dirname(test.testFile)
+            testsDonePerDir[testDir].append(test.testFile)
+            nTestsLeftPerDir[testDir] -= 1
+            if nTestsLeftPerDir[testDir] == 0:
+                moves.append(mover.submit(moveTestOutputs, testsDonePerDir.pop(testDir), regressionPath, resultsPath))
+
+    for testFile, log in logs:
+        try:
+            log.result()
+        except Exception as err:
+            print('ERROR: Cannot log "{0}" due to:'.format(testFile))
+            print('"{0}"'.format(err))
 
-    # stop threads
-    for thread in threadPool:
-        thread.join()
+    for move in moves:
+        try:
+            move.result()
+        except OSError as err:
+            print('ERROR: Cannot move test output due to:')
+            print('"{0}"'.format(err))
 
-    print('\n{0}/{1} tests completed\n'.format(nPassed.get(), queueLength))
+    print('\n{0}/{1} tests completed\n'.format(nTestsPassed, queueLength))
 
-    # Move all generated output in regressionPath to outPath/results
-    moveTree(regressionPath, os.path.join(outPath, 'results'), ignore=shutil.ignore_patterns('*raw.fits'))
+    # Move any remaining generated output in regressionPath, e.g. that not sharing a test's rootname
+    try:
+        moveTree(regressionPath, resultsPath, ignore=ignoreSuffixes('raw.fits'), maxThreads=nIOThreads)
+    except shutil.Error as err:
+        print('ERROR: Cannot move all remaining output due to:')
+        for error in err.args[0]:
+            print('"{0}"'.format(error))
     print('\nTotal time taken: {0}'.format(str(formatSeconds(time.time() - startTime))))
 
 if __name__ == "__main__":